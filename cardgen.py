@@ -1,10 +1,16 @@
 import argparse
-import fractions
+import concurrent.futures
+import functools
+import json
 import logging
+import math
 import os.path
-import random
+import shutil
+import subprocess
 import sys
 
+import numpy as np
+import PIL
 from PIL import (
     Image,
     ImageColor,
@@ -54,33 +60,41 @@ FONTS = [
     "/usr/share/fonts/truetype/noto/NotoMono-Regular.ttf",
 ]
 
+FONT_CACHE = os.path.expanduser("~/.cache/cardgen/font_path")
+
+MIN_SCALE = 0.1  # Below this the smallest font would get a size of zero.
+
 
 class Card():
 
-    def __init__(self, colors, font_path, size=(750, 1050)):
+    frame_cache = {}  # Rendered frames, shared by all cards with the same colors and size.
+
+    def __init__(self, colors, font_path, size=(750, 1050), scale=1.0):
         self.colors = colors
         self.font_path = font_path
         self.size = size
 
-        self.im = Image.new("RGB", self.size, self.colors["background"])
-        self.grid_size = 30  # 30 results in a grid 25 x 35 when the card is 750 x 1050.
-        self.grid = (size[0] // self.grid_size, size[1] // self.grid_size)
+        # A scale below 1 draws the card faster at a lower resolution, e.g. for previews. The grid must stay whole
+        # pixels, so the scale is rounded to what the grid allows and the image follows the grid, not the other way.
+        self.grid_size = max(round(30 * scale), 1)  # 30 results in a grid 25 x 35 when the card is 750 x 1050.
+        self.scale = self.grid_size / 30
+
+        self.im = Image.new("RGB", (round(size[0] * self.scale), round(size[1] * self.scale)), self.colors["background"])
+        self.grid = (self.im.size[0] // self.grid_size, self.im.size[1] // self.grid_size)
         self.draw = ImageDraw.Draw(self.im)
+        self.border_width = 2 * max(round(4 * self.scale), 1)  # Keep the width even, see draw_box.
 
-        self.big_font = ImageFont.truetype(self.font_path, int(self.grid_size))
-        self.medium_font = ImageFont.truetype(self.font_path, int(self.grid_size / 1.2))
-        self.small_font = ImageFont.truetype(self.font_path, int(self.grid_size / 1.8))
+        self.big_font = _load_font(self.font_path, int(self.grid_size))
+        self.medium_font = _load_font(self.font_path, int(self.grid_size / 1.2))
+        self.small_font = _load_font(self.font_path, int(self.grid_size / 1.8))
 
     def coordinates2xy(self, coordinates, x_grow=0, y_grow=0):
-        xy = [coordinates[0] * self.grid_size,
-              coordinates[1] * self.grid_size,
-              coordinates[2] * self.grid_size,
-              coordinates[3] * self.grid_size]
+        xy = [coordinate * self.grid_size for coordinate in coordinates]
 
-        xy[0] = xy[0] if xy[0] >= 0 else self.im.size[0] + xy[0]
-        xy[1] = xy[1] if xy[1] >= 0 else self.im.size[1] + xy[1]
-        xy[2] = xy[2] if xy[2] >= 0 else self.im.size[0] + xy[2]
-        xy[3] = xy[3] if xy[3] >= 0 else self.im.size[1] + xy[3]
+        # Negative coordinates are relative to the right/bottom edge
+        for i, dimension in enumerate(self.im.size * 2):
+            if xy[i] < 0:
+                xy[i] += dimension
 
         if x_grow:
             xy[0] = xy[0] - (x_grow * self.grid_size)
@@ -93,11 +107,19 @@ class Card():
 
     def save(self, file_path):
         logging.info("Saving card to: %s", os.path.abspath(file_path))
-        self.im.save(file_path)
+        im = self.im.resize(self.size, Image.BILINEAR) if self.im.size != self.size else self.im
+
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension in (".jpg", ".jpeg"):
+            im.save(file_path, "JPEG", optimize=True)
+        elif extension == ".png":
+            im.save(file_path, "PNG", compress_level=6)
+        else:
+            im.save(file_path)
 
     def draw_frame(self):
         coordinates = [1, 1, -1, -3]
-        paste_noisy_rectangle(self.im, self.coordinates2xy(coordinates), self.colors["second"], self.colors["main"], pixel_size=6, blur_radius=2)
+        paste_noisy_rectangle(self.im, self.coordinates2xy(coordinates), self.colors["second"], self.colors["main"], pixel_size=max(round(6 * self.scale), 1), blur_radius=2 * self.scale, min_radius=50 * self.scale, max_radius=100 * self.scale, circle_area=1000 * self.scale ** 2, cache=self.frame_cache)
 
     def draw_content(self, image_path=None, head1=None, head2=None, text=None, stats=None):
 
@@ -108,23 +130,24 @@ class Card():
             coordinates = [2, 4, -2, -6]
         else:
             coordinates = [2, 4, -2, 23]
+        xy = self.coordinates2xy(coordinates)
         if image_path:
-            paste_image(self.im, self.coordinates2xy(coordinates), image_path)
+            paste_image(self.im, xy, image_path)
         else:
-            paste_noisy_rectangle(self.im, self.coordinates2xy(coordinates), self.colors["second"], self.colors["main"], pixel_size=30)
-        draw_box(self.draw, self.coordinates2xy(coordinates), fill=None, outline=self.colors["main"], width=8)
+            paste_noisy_rectangle(self.im, xy, self.colors["second"], self.colors["main"], pixel_size=self.grid_size, blur_radius=self.scale, min_radius=50 * self.scale, max_radius=100 * self.scale, circle_area=1000 * self.scale ** 2)
+        draw_box(self.draw, xy, fill=None, outline=self.colors["main"], width=self.border_width)
 
         if not large_image:
             # Bottom box
             coordinates = [2, 25, -2, -2]
-            draw_box(self.draw, self.coordinates2xy(coordinates), fill=self.colors["card"], outline=self.colors["main"], width=8)
+            xy = self.coordinates2xy(coordinates)
+            draw_box(self.draw, xy, fill=self.colors["card"], outline=self.colors["main"], width=self.border_width)
             if text:
-                xy = self.coordinates2xy(coordinates)
                 write_text(self.draw, xy, text, self.medium_font)
 
         # Title bar
         coordinates = [2, 2, -2, 4]
-        draw_box(self.draw, self.coordinates2xy(coordinates, x_grow=0.5), round=True, fill=self.colors["card"], outline=self.colors["main"], width=8)
+        draw_box(self.draw, self.coordinates2xy(coordinates, x_grow=0.5), round=True, fill=self.colors["card"], outline=self.colors["main"], width=self.border_width)
         if head1:
             draw_center_text(self.draw, self.coordinates2xy(coordinates), head1, font=self.big_font)
 
@@ -133,13 +156,13 @@ class Card():
             coordinates = [2, -6, -2, -4]
         else:
             coordinates = [2, 23, -2, 25]
-        draw_box(self.draw, self.coordinates2xy(coordinates, x_grow=0.5), round=True, fill=self.colors["card"], outline=self.colors["main"], width=8)
+        draw_box(self.draw, self.coordinates2xy(coordinates, x_grow=0.5), round=True, fill=self.colors["card"], outline=self.colors["main"], width=self.border_width)
         if head2:
             draw_center_text(self.draw, self.coordinates2xy(coordinates), head2, font=self.big_font)
 
         # Stats bar
         coordinates = [-6, -3, -2, -1]
-        draw_box(self.draw, self.coordinates2xy(coordinates, x_grow=0.5), round=True, fill=self.colors["card"], outline=self.colors["main"], width=8)
+        draw_box(self.draw, self.coordinates2xy(coordinates, x_grow=0.5), round=True, fill=self.colors["card"], outline=self.colors["main"], width=self.border_width)
         if stats:
             draw_center_text(self.draw, self.coordinates2xy(coordinates), stats, font=self.big_font, horizontal=True)
 
@@ -154,10 +177,7 @@ def draw_box(draw, xy, round=False, fill=None, outline=None, width=2):
             logging.warning("Box border width should preferably be divisibly by two to render properly: %d.", width)
         # Make sure the outline/border is drawn on the edge of the box, not inside.
         # This makes sure boxes next to each other don't get double borders.
-        xy[0] = xy[0] - width / 2
-        xy[1] = xy[1] - width / 2
-        xy[2] = xy[2] + width / 2
-        xy[3] = xy[3] + width / 2
+        xy = [xy[0] - width / 2, xy[1] - width / 2, xy[2] + width / 2, xy[3] + width / 2]
 
     radius = 0 if not round else (xy[3] - xy[1]) / 2.3
     draw.rounded_rectangle(xy, radius, fill=fill, outline=outline, width=width)
@@ -166,82 +186,167 @@ def draw_box(draw, xy, round=False, fill=None, outline=None, width=2):
 def draw_center_text(draw, xy, text, font, fill="#000", horizontal=False):
     """Draws the given text in the center of a rectangle xy. Only vertical align unless horizontal."""
 
-    m_width = draw.textlength("T", font=font)
-    bounding_box = font.getbbox(text)
+    m_width = _text_length(font, "T")
+    bounding_box = _text_bbox(font, text)
     x_grow = (xy[2] - xy[0] - (bounding_box[2] - bounding_box[0])) / 2 if horizontal else m_width
     y_grow = (xy[3] - xy[1] - (bounding_box[3] - bounding_box[1])) / 2
     y_grow = y_grow - (m_width / 5)  # It looks better if you move the text a bit up
     draw.text((xy[0] + x_grow, xy[1] + y_grow), text, font=font, fill=fill)
 
 
+def find_font():
+    """Returns the path to a monospace font, or None. The path is cached in FONT_CACHE between runs."""
+
+    try:
+        with open(FONT_CACHE) as f:
+            font_path = f.read().strip()
+        if os.path.exists(font_path):
+            return font_path
+    except OSError:
+        pass
+
+    font_path = None
+    if shutil.which("fc-match"):
+        try:
+            font_path = subprocess.check_output(["fc-match", "-f", "%{file}", "mono"], text=True).strip()
+        except (OSError, subprocess.CalledProcessError):
+            logging.warning("Unable to look up a font with fc-match.")
+    if not font_path or not os.path.exists(font_path):
+        font_path = next((font for font in FONTS if os.path.exists(font)), None)
+    if not font_path:
+        return None
+
+    try:
+        os.makedirs(os.path.dirname(FONT_CACHE), exist_ok=True)
+        with open(FONT_CACHE, "w") as f:
+            f.write(font_path)
+    except OSError:
+        logging.warning("Unable to cache font path to: %s.", FONT_CACHE)
+
+    return font_path
+
+
 def get_color_gradient(c1, c2, count=100):
-    """Returns a list of count colors between the two colors c1 and c2."""
+    """Returns an array of count RGB colors between the two colors c1 and c2."""
 
-    colors = []
+    rgb1 = np.array(ImageColor.getrgb(c1)[:3], dtype=np.int16)
+    rgb2 = np.array(ImageColor.getrgb(c2)[:3], dtype=np.int16)
 
-    rgb1 = ImageColor.getrgb(c1)
-    rgb2 = ImageColor.getrgb(c2)
-    diff = (rgb2[0] - rgb1[0], rgb2[1] - rgb1[1], rgb2[2] - rgb1[2])
-    step = (diff[0] / count, diff[1] / count, diff[2] / count)
+    return np.linspace(rgb1, rgb2, count, endpoint=False).astype(np.uint8)
 
-    for i in range(count):
-        color = tuple(abs(int(value)) for value in (rgb1[0] + step[0] * i, rgb1[1] + step[1] * i, rgb1[2] + step[2] * i))
-        colors.append(color)
 
-    return colors
+@functools.lru_cache(maxsize=64)
+def _load_font(font_path, size):
+    """Returns the font at font_path in the given size. Fonts are cached, so cards can share them."""
+    return ImageFont.truetype(font_path, size)
 
 
 def paste_image(image, xy, image_path):
     temp = Image.open(image_path)
 
-    image_ratio = fractions.Fraction(temp.size[0], temp.size[1])
-    box_ratio = fractions.Fraction(xy[2] - xy[0], xy[3] - xy[1])
+    image_width, image_height = temp.size
+    box_width, box_height = xy[2] - xy[0], xy[3] - xy[1]
 
-    if image_ratio != box_ratio:
-        logging.warning("The given image ratio (%d:%d) does not match the box ratio (%d:%d). Image will be scaled.", *image_ratio.as_integer_ratio(), *box_ratio.as_integer_ratio())
-    if xy[2] - xy[0] > temp.size[0] or xy[3] - xy[1] > temp.size[1]:
-        logging.warning("The given image (%s) is smaller than the box (%s). Image will be scaled.", f"{temp.size[0]} x {temp.size[1]}", f"{xy[2] - xy[0]} x {xy[3] - xy[1]}")
+    if image_width * box_height != image_height * box_width:
+        logging.warning("The given image ratio (%s) does not match the box ratio (%s). Image will be scaled.", f"{image_width}:{image_height}", f"{box_width}:{box_height}")
+    if box_width > image_width or box_height > image_height:
+        logging.warning("The given image (%s) is smaller than the box (%s). Image will be scaled.", f"{image_width} x {image_height}", f"{box_width} x {box_height}")
 
-    temp = temp.resize((xy[2] - xy[0], xy[3] - xy[1]))
+    # Let JPEGs decode at a reduced size when they are larger than the box, and use a fast filter when scaling up
+    temp.draft("RGB", (box_width, box_height))
+    resample = Image.LANCZOS if box_width <= image_width and box_height <= image_height else Image.BILINEAR
+    temp = temp.resize((box_width, box_height), resample)
     image.paste(temp, (xy[0], xy[1]))
 
 
-def paste_noisy_rectangle(image, xy, color1, color2, pixel_size=1, blur_radius=1):
-    colors = get_color_gradient(color1, color2, 5)
-
-    temp = Image.new("RGB", (xy[2] - xy[0], xy[3] - xy[1]))
+def paste_noisy_rectangle(image, xy, color1, color2, pixel_size=1, blur_radius=1, min_radius=50, max_radius=100, circle_area=1000, downscale=3, cache=None):
+    """Pastes a rectangle of pixel noise and circles into xy. It is drawn up to downscale times smaller and scaled up.
+
+    One circle is drawn per circle_area pixels. If a cache dict is given, the rectangle is only drawn once for the same
+    arguments and reused after that."""
+    width, height = xy[2] - xy[0], xy[3] - xy[1]
+
+    key = (color1, color2, pixel_size, blur_radius, min_radius, max_radius, circle_area, downscale, width, height)
+    if cache is not None and key in cache:
+        image.paste(cache[key], (xy[0], xy[1]))
+        return
+
+    palette = get_color_gradient(color1, color2, 5)
+    rng = np.random.default_rng()
+    # Scale by at most downscale, and by no more than the blur can hide: the bilinear upscale blurs about as much as a
+    # box blur with a variance of (scale ** 2 - 1) / 6, and a blur_radius box blur has blur_radius * (blur_radius + 1) / 3.
+    # Only scale by what divides pixel_size, so the noise pixels stay whole.
+    max_scale = min(downscale, int(math.sqrt(2 * blur_radius * (blur_radius + 1) + 1)))
+    scale = max(factor for factor in range(1, max(max_scale, 1) + 1) if pixel_size % factor == 0)
+    small_pixel_size = pixel_size // scale
+
+    # Draw pixel noise with the colors. Pick a color per pixel_size x pixel_size tile and scale the tiles up.
+    # Round the tile grid up so partial tiles at the edges are covered, then crop to the wanted size.
+    # Everything is drawn with palette indexes in a "P" image until it is converted for the blur.
+    grid_height, grid_width = -(-height // pixel_size), -(-width // pixel_size)
+    indexes = rng.integers(0, len(palette), size=(grid_height, grid_width), dtype=np.uint8)
+    temp = Image.fromarray(indexes, "P")
+    temp.putpalette(palette.tobytes())
+    temp = temp.resize((grid_width * small_pixel_size, grid_height * small_pixel_size), Image.NEAREST)
+    temp = temp.crop((0, 0, -(-width // scale), -(-height // scale)))
     draw = ImageDraw.Draw(temp)
 
-    # Draw pixel noise with the colors
-    for x in range(0, temp.size[0], pixel_size):
-        for y in range(0, temp.size[1], pixel_size):
-            draw.rectangle((x, y, x + pixel_size, y + pixel_size), fill=random.choice(colors))
-
     # Draw some random circles
-    min_radius = 50
-    max_radius = 100
-    for _ in range(temp.size[0] * temp.size[1] // 1000):
-        x, y = random.randint(-min_radius // 2, temp.im.size[0] + min_radius // 2), random.randint(-min_radius // 2, temp.im.size[1] + min_radius // 2)
-        size = random.randint(min_radius, max_radius)
-        draw.ellipse((x, y, x + size, y + size), outline=random.choice(colors), width=pixel_size)
+    min_radius = int(min_radius // scale)
+    max_radius = int(max_radius // scale)
+    count = int(width * height // circle_area)
+    xs = rng.integers(-min_radius // 2, temp.size[0] + min_radius // 2 + 1, count).tolist()
+    ys = rng.integers(-min_radius // 2, temp.size[1] + min_radius // 2 + 1, count).tolist()
+    sizes = rng.integers(min_radius, max_radius + 1, count).tolist()
+    color_indexes = rng.integers(0, len(palette), count).tolist()
+    for x, y, size, color_index in zip(xs, ys, sizes, color_indexes):
+        draw.ellipse((x, y, x + size, y + size), outline=color_index, width=small_pixel_size)
+
+    # Only blur at full size by what is left of the blur after the upscale
+    temp = temp.convert("RGB").resize((temp.size[0] * scale, temp.size[1] * scale), Image.BILINEAR).crop((0, 0, width, height))
+    variance = blur_radius * (blur_radius + 1) / 3 - (scale ** 2 - 1) / 6
+    if variance > 0:
+        temp = temp.filter(ImageFilter.BoxBlur((math.sqrt(1 + 12 * variance) - 1) / 2))
+
+    if cache is not None:
+        cache[key] = temp
+    image.paste(temp, (xy[0], xy[1]))
 
-    temp = temp.filter(ImageFilter.BoxBlur(blur_radius))
 
-    image.paste(temp, (xy[0], xy[1]))
+def render_card(spec):
+    """Draws and saves a card from a dict with the keys color, font and output, and optionally head1, head2, text, stats, image and scale."""
+    card = Card(COLORS[spec["color"]], font_path=spec["font"], scale=spec.get("scale", 1.0))
+    card.draw_frame()
+    card.draw_content(image_path=spec.get("image"), head1=spec.get("head1"), head2=spec.get("head2"), text=spec.get("text"), stats=spec.get("stats"))
+    card.save(spec["output"])
+
+
+@functools.lru_cache(maxsize=512)
+def _text_bbox(font, text):
+    """Returns the bounding box of text in the given font. Boxes are cached, as headers and the footer repeat."""
+    return font.getbbox(text)
+
+
+@functools.lru_cache(maxsize=1024)
+def _text_length(font, text):
+    """Returns the length of text in the given font. Lengths are cached, as the same text is measured often."""
+    return font.getlength(text)
 
 
 def write_text(draw, xy, text, font, fill="#000"):
     """Try to write text within a bounding box xy. Words that match '\\n' will be replaced with newlines."""
-    m_width = draw.textlength("T", font=font)
+    m_width = _text_length(font, "T")
     xy = [xy[0] + m_width, xy[1] + m_width, xy[2] - m_width, xy[3] - m_width]
 
     words = text.strip().split(" ")
+    space_width = _text_length(font, " ")
 
+    # Keep a running width of the line instead of measuring the whole line again for every word
     new_text = ""
     line = ""
     width = 0
     for word in words:
-        word_width = draw.textlength(word, font=font)
+        word_width = _text_length(font, word)
 
         if word_width > xy[2] - xy[0]:
             logging.warning("Word is to long to be printed properly: %s.", repr(word))
@@ -249,13 +354,14 @@ def write_text(draw, xy, text, font, fill="#000"):
         if word == "\\n":
             new_text += f"{line}\n"
             line = ""
+            width = 0
         elif width + word_width < xy[2] - xy[0]:
+            width = width + space_width + word_width if line else word_width
             line = f"{line} {word}" if line else word
-            width = draw.textlength(line, font=font)
         else:
             new_text += f"{line}\n"
             line = word
-            width = draw.textlength(line, font=font)
+            width = word_width
 
     new_text += line
 
@@ -269,22 +375,37 @@ def write_text(draw, xy, text, font, fill="#000"):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--color", required=True, choices=COLORS.keys(), help="Name of card color")
-    parser.add_argument("-o", "--output", default="output.jpg", help="Path to output file.")
+    card_or_batch = parser.add_mutually_exclusive_group(required=True)
+    card_or_batch.add_argument("-c", "--color", choices=COLORS.keys(), help="Name of card color")
+    parser.add_argument("-o", "--output", help="Path to output file. Defaults to output.jpg.")
     parser.add_argument("-h1", "--head1", help="First text header on card")
     parser.add_argument("-h2", "--head2", help="Second text header on card")
     parser.add_argument("-t", "--text", help="Text in text box on card")
     parser.add_argument("-s", "--stats", help="Text in stats box")
     parser.add_argument("-i", "--image", help="Path to image")
     parser.add_argument("-f", "--font", help="Path to font")
+    parser.add_argument("--scale", type=float, default=1.0, help=f"Draw the card at a lower resolution and scale it up, e.g. 0.5 for fast previews. Between {MIN_SCALE} and 1.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log more about what is being done")
+    card_or_batch.add_argument("-b", "--batch", help="Path to JSON file with a list of cards to generate in parallel. Cards use the same keys as the long options above.")
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    # Pillow-SIMD is a drop-in replacement for Pillow with faster resize and blur. There is no API to tell them apart,
+    # but Pillow-SIMD releases are versioned X.Y.Z.postN, so a .post version is a good hint.
+    if ".post" in PIL.__version__:
+        logging.info("Pillow version %s looks like Pillow-SIMD.", PIL.__version__)
+    else:
+        logging.info("Pillow version %s does not look like Pillow-SIMD.", PIL.__version__)
+
+    if args.batch and any((args.output, args.head1, args.head2, args.text, args.stats, args.image)):
+        parser.error("argument -b/--batch: not allowed with card options, set them in the batch file")
+    if not MIN_SCALE <= args.scale <= 1:
+        parser.error(f"argument --scale: must be between {MIN_SCALE} and 1: {args.scale}")
+
     if not args.font:
-        for font in FONTS:
-            if os.path.exists(font):
-                font_path = font
-                break
-        else:
+        font_path = find_font()
+        if not font_path:
             logging.error("Unable to find a font.")
             sys.exit(1)
     else:
@@ -293,7 +414,28 @@ if __name__ == "__main__":
             sys.exit(1)
         font_path = args.font
 
-    card = Card(COLORS[args.color], font_path=font_path)
-    card.draw_frame()
-    card.draw_content(image_path=args.image, head1=args.head1, head2=args.head2, text=args.text, stats=args.stats)
-    card.save(args.output)
+    if args.batch:
+        with open(args.batch) as f:
+            specs = json.load(f)
+        if not isinstance(specs, list):
+            logging.error("Batch file must contain a list of cards: %s.", args.batch)
+            sys.exit(1)
+        for spec in specs:
+            if not isinstance(spec, dict):
+                logging.error("Card must be an object: %s.", spec)
+                sys.exit(1)
+            if spec.get("color") not in COLORS or not spec.get("output"):
+                logging.error("Card needs a valid color and an output: %s.", spec)
+                sys.exit(1)
+            spec.setdefault("font", font_path)
+            if not os.path.exists(spec["font"]):
+                logging.error("Unable to find font: %s.", spec["font"])
+                sys.exit(1)
+            spec.setdefault("scale", args.scale)
+            if not isinstance(spec["scale"], (int, float)) or not MIN_SCALE <= spec["scale"] <= 1:
+                logging.error("Card scale must be between %s and 1: %s.", MIN_SCALE, spec)
+                sys.exit(1)
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            list(executor.map(render_card, specs))
+    else:
+        render_card({"color": args.color, "font": font_path, "output": args.output or "output.jpg", "head1": args.head1, "head2": args.head2, "text": args.text, "stats": args.stats, "image": args.image, "scale": args.scale})